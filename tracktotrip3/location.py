@@ -1,12 +1,23 @@
 """
 Location class and methods
 """
+import heapq
+import math
+import operator
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from functools import partial
 import requests
+from requests.adapters import HTTPAdapter
 import numpy as np
-from sklearn.cluster import DBSCAN
-from .point import Point
-from .utils import estimate_meters_to_deg
+from scipy.spatial import cKDTree
+from .point import Point, PointBuffer, EARTH_RADIUS, ONE_DEGREE, haversine_distances
+
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
 
 
 GOOGLE_PLACES_URL = 'https://maps.googleapis.com/maps/api/place/nearbysearch' \
@@ -15,78 +26,366 @@ GOOGLE_PLACES_URL = 'https://maps.googleapis.com/maps/api/place/nearbysearch' \
 FOURSQUARE_URL = 'https://api.foursquare.com/v3/places/search?' \
         'll=%f,%f&radius=%d'
 
-GG_CACHE = {}
-FS_CACHE = {}
+# Caches index (:obj:`Point`, values) entries by rounded position, for exact
+# hits, and in a spatial grid, for nearby hits
+CACHE_CELL_METERS = 100
+CACHE_CELL_SIZE = CACHE_CELL_METERS / ONE_DEGREE
+# Longitude cells wrap around at the antimeridian
+CACHE_LON_CELLS = int(round(360 / CACHE_CELL_SIZE))
+CACHE_KEY_DIGITS = 5
+GG_CACHE = {'positions': {}, 'cells': defaultdict(list)}
+FS_CACHE = {'positions': {}, 'cells': defaultdict(list)}
+
+REQUEST_TIMEOUT = 10
+
+def new_session(debug = False):
+    """ Creates an HTTP session with pooled keep-alive connections
+
+    Returns:
+        :obj:`requests.Session`
+    """
+    session = requests.Session()
+    session.mount('https://', HTTPAdapter(pool_connections=8, pool_maxsize=8))
+    session.headers.update({'Connection': 'keep-alive'})
+    return session
+
+# One session per provider, as both providers may be queried at the same time
+GG_SESSION = new_session()
+FS_SESSION = new_session()
+
+# Runs the Google and Foursquare queries side by side
+QUERY_EXECUTOR = ThreadPoolExecutor(max_workers=2)
+
+def cache_cell(point, debug = False):
+    """ Grid cell of a point in the query caches
+
+    Args:
+        point (:obj:`Point`)
+    Returns:
+        (int, int): Latitude and longitude cell indexes
+    """
+    return (
+        int(round(point.lat / CACHE_CELL_SIZE)),
+        int(round(point.lon / CACHE_CELL_SIZE)) % CACHE_LON_CELLS
+    )
+
+def cache_key(point, debug = False):
+    """ Rounded position of a point in the query caches
+
+    Args:
+        point (:obj:`Point`)
+    Returns:
+        (float, float): Latitude and longitude, rounded to CACHE_KEY_DIGITS
+    """
+    return (round(point.lat, CACHE_KEY_DIGITS), round(point.lon, CACHE_KEY_DIGITS))
+
+def insert_cache(cache, point, values, debug = False):
+    """ Caches the values of a point
+
+    Args:
+        cache (:obj:`dict`): GG_CACHE or FS_CACHE
+        point (:obj:`Point`)
+        values: Values to cache
+    """
+    cache['positions'][cache_key(point, debug)] = (point, values)
+    cache['cells'][cache_cell(point, debug)].append((point, values))
 
 def from_cache(cache, point, threshold, debug = False):
-    for entry in list(cache.keys()):
-        if point.distance(entry) < threshold:
-            return cache[entry]
+    """ Gets the values cached near a point
+
+    A point cached at the same rounded position is checked first, otherwise
+    only the grid cells within threshold of the point are searched.
+
+    Args:
+        cache (:obj:`dict`): GG_CACHE or FS_CACHE
+        point (:obj:`Point`)
+        threshold (float): Max distance to a cached point, in meters
+    Returns:
+        Cached values, or None if there aren't any
+    """
+    hit = cache['positions'].get(cache_key(point, debug))
+    if hit is not None and point.distance(hit[0]) < threshold:
+        return hit[1]
+
+    cells = cache['cells']
+    lat_cell, lon_cell = cache_cell(point, debug)
+    lat, lon = point.lat, point.lon
+    lat_reach = int(math.ceil(threshold / CACHE_CELL_METERS))
+
+    # Bounding box of the threshold, in degrees, rejects far entries cheaply
+    lat_threshold = threshold / ONE_DEGREE
+
+    # A degree of longitude shrinks away from the equator, most at the box's
+    # poleward edge. Near the poles the threshold may span every longitude
+    lon_scale = math.cos(math.radians(min(abs(lat) + lat_threshold, 90.)))
+    if threshold >= 180. * ONE_DEGREE * lon_scale:
+        lon_reach = CACHE_LON_CELLS // 2
+        lon_threshold = 180.
+    else:
+        lon_reach = int(math.ceil(threshold / (CACHE_CELL_METERS * lon_scale)))
+        lon_threshold = threshold / (ONE_DEGREE * lon_scale)
+
+    if (2 * lat_reach + 1) * (2 * lon_reach + 1) > len(cells):
+        # Fewer cached cells than cells to probe, filters the cached ones instead
+        buckets = (
+            entries for (e_lat_cell, e_lon_cell), entries in cells.items()
+            if abs(e_lat_cell - lat_cell) <= lat_reach
+            and min((e_lon_cell - lon_cell) % CACHE_LON_CELLS,
+                    (lon_cell - e_lon_cell) % CACHE_LON_CELLS) <= lon_reach
+        )
+    else:
+        buckets = (
+            cells.get((lat_cell + d_lat, (lon_cell + d_lon) % CACHE_LON_CELLS), ())
+            for d_lat in range(-lat_reach, lat_reach + 1)
+            for d_lon in range(-lon_reach, lon_reach + 1)
+        )
+
+    for entries in buckets:
+        for entry, values in entries:
+            d_lon = abs(entry.lon - lon)
+            if abs(entry.lat - lat) > lat_threshold or min(d_lon, 360. - d_lon) > lon_threshold:
+                continue
+            if point.distance(entry) < threshold:
+                return values
+    return None
 
 def google_insert_cache(point, values, debug = False):
-    global GG_CACHE
-    GG_CACHE[point] = values
+    insert_cache(GG_CACHE, point, values, debug)
 
 def foursquare_insert_cache(point, values, debug = False):
-    global FS_CACHE
-    FS_CACHE[point] = values
+    insert_cache(FS_CACHE, point, values, debug)
 
 
-def compute_centroid(points, debug = False):
+def compute_centroid(points_arr, debug = False):
     """ Computes the centroid of set of points
 
     Args:
-        points (:obj:`list` of :obj:`Point`)
+        points_arr (:obj:`numpy.ndarray`): (N, 2) array of longitude, latitude pairs
     Returns:
         :obj:`Point`
     """
-    lats = [p[1] for p in points]
-    lons = [p[0] for p in points]
-    return Point(np.mean(lats), np.mean(lons), None)
+    mean = points_arr.mean(axis=0)
+    return Point(mean[1], mean[0], None)
+
+def dbscan(points, max_distance, min_samples, with_counts = False, debug = False):
+    """ DBSCAN clustering of positions
+
+    Positions are placed on the unit sphere, where the straight line (chord)
+    distance grows with the great-circle distance, so a KD-tree finds the
+    neighbourhoods.
+
+    Args:
+        points (:obj:`numpy.ndarray`): (N, 2) array of longitude, latitude pairs
+        max_distance (float): Max neighbour distance, in meters
+        min_samples (int): Minimum number of samples of a core point, itself included
+        with_counts (bool): Also return the number of neighbours of each point
+    Returns:
+        :obj:`numpy.ndarray`: Cluster label of each point, -1 for noise. With
+            with_counts, a tuple with the labels and the neighbour counts,
+            each point included in its own count
+    """
+    lons, lats = np.radians(points).T
+    cos_lats = np.cos(lats)
+    xyz = np.column_stack((cos_lats * np.cos(lons), cos_lats * np.sin(lons), np.sin(lats)))
+    radius = 2 * math.sin(max_distance / EARTH_RADIUS / 2)
+
+    neighbourhoods = cKDTree(xyz).query_ball_point(xyz, radius)
+    counts = np.fromiter(
+        (len(neighbours) for neighbours in neighbourhoods), np.int64, len(neighbourhoods)
+    )
+    is_core = counts >= min_samples
+
+    labels = np.full(len(points), -1, dtype=np.int64)
+    label = 0
+    for i, core in enumerate(is_core):
+        if not core or labels[i] != -1:
+            continue
+
+        labels[i] = label
+        queue = deque([i])
+        while queue:
+            for j in neighbourhoods[queue.popleft()]:
+                if labels[j] == -1:
+                    labels[j] = label
+                    # Border points join the cluster, but don't expand it
+                    if is_core[j]:
+                        queue.append(j)
+        label += 1
+
+    if with_counts:
+        return labels, counts
+    return labels
+
+class ClusterState(object):
+    """ Incremental clustering state of a location cluster
+
+    Kept by the caller alongside its cluster, and passed to every
+    update_location_centroid call of that cluster. The cluster must only grow
+    through those calls.
+
+    Attributes:
+        buffer (:obj:`PointBuffer`): Positions of the cluster's points
+        labels (:obj:`numpy.ndarray`): DBSCAN label of each point
+        counts (:obj:`numpy.ndarray`): Number of neighbours of each point, itself included
+        biggest (int): Label of the biggest DBSCAN cluster, None if there isn't one
+        total (:obj:`numpy.ndarray`): Sum of the positions in the biggest cluster
+        size (int): Number of points in the biggest cluster
+        max_distance (float): Max neighbour distance of the DBSCAN result
+        min_samples (int): Minimum number of samples of the DBSCAN result
+    """
+    def __init__(self, debug = False):
+        self.buffer = None
+        self.labels = None
+        self.counts = None
+        self.biggest = None
+        self.total = None
+        self.size = 0
+        self.max_distance = None
+        self.min_samples = None
+        self.debug = debug
+
+    def matches(self, cluster, max_distance, min_samples):
+        """ Checks if the state holds every point of a cluster but the last one
+
+        Only the size, and the first and last points, are compared.
+
+        Args:
+            cluster (:obj:`list` of :obj:`Point`): Location cluster
+            max_distance (float): Max neighbour distance
+            min_samples (int): Minimum number of samples
+        Returns:
+            bool
+        """
+        if self.buffer is None or len(self.buffer) != len(cluster) - 1 \
+                or self.max_distance != max_distance or self.min_samples != min_samples:
+            return False
+
+        # Cheap check against points replaced in place: first and last stored ones
+        points = self.buffer.view()
+        first, last = cluster[0], cluster[-2]
+        return points[0, 0] == first.lon and points[0, 1] == first.lat \
+            and points[-1, 0] == last.lon and points[-1, 1] == last.lat
+
+    def seed(self, buf, labels, counts, biggest, max_distance, min_samples):
+        """ Resets the state from a DBSCAN result
 
-def update_location_centroid(point, cluster, max_distance, min_samples, debug = False):
+        Args:
+            buf (:obj:`PointBuffer`): Positions of the cluster's points
+            labels (:obj:`numpy.ndarray`): DBSCAN label of each point
+            counts (:obj:`numpy.ndarray`): Number of neighbours of each point
+            biggest (int): Label of the biggest cluster, None if there isn't one
+            max_distance (float): Max neighbour distance
+            min_samples (int): Minimum number of samples
+        """
+        self.buffer = buf
+        self.labels = labels
+        self.counts = counts
+        self.biggest = biggest
+        in_biggest = labels == biggest
+        self.total = buf.view()[in_biggest].sum(axis=0)
+        self.size = int(in_biggest.sum())
+        self.max_distance = max_distance
+        self.min_samples = min_samples
+
+    def add(self, point):
+        """ Adds a point that joins the biggest cluster, without reclustering
+
+        That's the case if all the point's neighbours are in the biggest cluster,
+        at least one of them is a core point, and no neighbour becomes a core
+        point. DBSCAN would then label every other
+        point as before.
+
+        Args:
+            point (:obj:`Point`): Point added to the cluster
+        Returns:
+            :obj:`Point`: Centroid of the biggest cluster, or None if the
+                point wasn't added and the cluster must be recomputed
+        """
+        if self.biggest is None:
+            return None
+
+        points = self.buffer.view()
+        dists = haversine_distances(points[:, 1], points[:, 0], point.lat, point.lon, self.debug)
+        neighbours = np.flatnonzero(dists <= self.max_distance)
+        if len(neighbours) == 0 or (self.labels[neighbours] != self.biggest).any():
+            return None
+
+        counts = self.counts[neighbours]
+        own_count = len(neighbours) + 1
+        if (counts + 1 == self.min_samples).any():
+            return None
+        # Being a core point doesn't make it reachable, a core neighbour does
+        if not (counts >= self.min_samples).any():
+            return None
+
+        xy_point = np.array((point.lon, point.lat), dtype=np.float64)
+        self.buffer.append(point)
+        self.counts[neighbours] += 1
+        self.counts = np.append(self.counts, own_count)
+        self.labels = np.append(self.labels, self.biggest)
+        self.total = self.total + xy_point
+        self.size += 1
+
+        mean = self.total / self.size
+        return Point(mean[1], mean[0], None)
+
+def update_location_centroid(point, cluster, max_distance, min_samples, debug = False,
+                             state = None):
     """ Updates the centroid of a location cluster with another point
 
+    With a state, points that only join the biggest cluster update its centroid
+    incrementally. DBSCAN runs every min_samples points, and whenever a point
+    could change any other cluster.
+
     Args:
         point (:obj:`Point`): Point to add to the cluster
         cluster (:obj:`list` of :obj:`Point`): Location cluster
         max_distance (float): Max neighbour distance
         min_samples (int): Minimum number of samples
+        state (:obj:`ClusterState`, optional): Clustering state of the cluster,
+            updated in place
     Returns:
         (:obj:`Point`, :obj:`list` of :obj:`Point`): Tuple with the location centroid
             and new point cluster (given cluster + given point)
     """
     cluster.append(point)
-    points = [p.gen2arr() for p in cluster]
-
-    # Estimates the epsilon
-    eps = estimate_meters_to_deg(max_distance, precision=6, debug=debug)
-
-    p_cluster = DBSCAN(eps=eps, min_samples=min_samples)
-    p_cluster.fit(points)
 
-    clusters = {}
-    for i, label in enumerate(p_cluster.labels_):
-        if label in list(clusters.keys()):
-            clusters[label].append(points[i])
-        else:
-            clusters[label] = [points[i]]
-
-    centroids = []
-    biggest_centroid_l = -float("inf")
-    biggest_centroid = None
+    # Too few points for a dense cluster, every point would be noise
+    if len(cluster) < min_samples:
+        points = PointBuffer.from_points(cluster, debug).view()
+        return compute_centroid(points, debug), cluster
+
+    # The state is stale if the cluster was changed elsewhere
+    if state is not None and state.matches(cluster, max_distance, min_samples):
+        # Between periodic DBSCAN refits, the point is clustered incrementally
+        # With min_samples of 1 or less every point is a core point, always refits
+        if min_samples > 1 and len(cluster) % min_samples != 0:
+            centroid = state.add(point)
+            if centroid is not None:
+                return centroid, cluster
+
+        buf = state.buffer
+        buf.append(point)
+    else:
+        buf = PointBuffer.from_points(cluster, debug)
 
-    for label, n_cluster in list(clusters.items()):
-        centroid = compute_centroid(n_cluster, debug)
-        centroids.append(centroid)
+    points = buf.view()
 
-        if label >= 0 and len(n_cluster) >= biggest_centroid_l:
-            biggest_centroid_l = len(n_cluster)
-            biggest_centroid = centroid
+    labels, counts = dbscan(points, max_distance, min_samples, True, debug)
 
-    if biggest_centroid is None:
+    # Noise (label -1) never wins, ties go to the last cluster
+    clustered = labels >= 0
+    biggest = None
+    if clustered.any():
+        sizes = np.bincount(labels[clustered])
+        biggest = len(sizes) - 1 - np.argmax(sizes[::-1])
+        biggest_centroid = compute_centroid(points[labels == biggest], debug)
+    else:
         biggest_centroid = compute_centroid(points, debug)
 
+    if state is not None:
+        state.seed(buf, labels, counts, biggest, max_distance, min_samples)
+
     return biggest_centroid, cluster
 
 def query_foursquare(point, max_distance, key, debug = False):
@@ -109,8 +408,9 @@ def query_foursquare(point, max_distance, key, debug = False):
     if not key:
         return []
 
-    if from_cache(FS_CACHE, point, max_distance, debug):
-        return from_cache(FS_CACHE, point, max_distance, debug)
+    cached = from_cache(FS_CACHE, point, max_distance, debug)
+    if cached is not None:
+        return cached
 
     headers = {
         'accept': 'application/json',
@@ -118,11 +418,11 @@ def query_foursquare(point, max_distance, key, debug = False):
     }
 
     url = FOURSQUARE_URL % (point.lat, point.lon, max_distance)
-    req = requests.get(url, headers=headers)
+    req = FS_SESSION.get(url, headers=headers, timeout=REQUEST_TIMEOUT)
 
     if req.status_code != 200:
         return []
-    response = req.json()
+    response = json_loads(req.content)
 
 
     result = []
@@ -162,27 +462,33 @@ def query_google(point, max_distance, key, debug = False):
     if not key:
         return []
 
-    if from_cache(GG_CACHE, point, max_distance, debug):
-        return from_cache(GG_CACHE, point, max_distance, debug)
+    cached = from_cache(GG_CACHE, point, max_distance, debug)
+    if cached is not None:
+        return cached
 
-    req = requests.get(GOOGLE_PLACES_URL % (
+    req = GG_SESSION.get(GOOGLE_PLACES_URL % (
         point.lat,
         point.lon,
         max_distance,
         key
-    ))
+    ), timeout=REQUEST_TIMEOUT)
 
     if req.status_code != 200:
         return []
     
-    response = req.json()
+    response = json_loads(req.content)
     results = response['results']
+
+    lats = np.fromiter((r['geometry']['location']['lat'] for r in results), float, len(results))
+    lons = np.fromiter((r['geometry']['location']['lng'] for r in results), float, len(results))
+    distances = haversine_distances(lats, lons, point.lat, point.lon, debug)
+
     # l = len(results)
     final_results = []
-    for local in results:
+    for local, dist in zip(results, distances.tolist()):
         final_results.append({
             'label': local['name'],
-            'distance': Point(local['geometry']['location']['lat'], local['geometry']['location']['lng'], None).distance(point),
+            'distance': dist,
             # 'rank': (l-i)/float(l),
             'types': local['types'],
             'suggestion_type': 'GOOGLE'
@@ -191,6 +497,77 @@ def query_google(point, max_distance, key, debug = False):
     google_insert_cache(point, final_results, debug)
     return final_results
 
+def make_location_inferer(
+        location_query,
+        max_distance,
+        use_google,
+        google_key,
+        use_foursquare,
+        foursquare_key,
+        limit,
+        debug = False
+    ):
+    """ Creates a location inferer for fixed settings
+
+    The settings are resolved once, so that inferring many points only runs
+    the enabled queries. See infer_location for the arguments.
+
+    Returns:
+        Function with signature, (:obj:`Point`) -> :obj:`Location`
+    """
+    queries = []
+    if use_google and google_key:
+        queries.append(partial(query_google, max_distance=max_distance, key=google_key, debug=debug))
+    if use_foursquare and foursquare_key:
+        queries.append(
+            partial(query_foursquare, max_distance=max_distance, key=foursquare_key, debug=debug)
+        )
+    queries = tuple(queries)
+    concurrent = len(queries) > 1
+    by_distance = operator.itemgetter('distance')
+    nsmallest = heapq.nsmallest
+
+    def infer(point):
+        """ Infers the semantic location of a (point) place
+
+        Args:
+            point (:obj:`Point`): Point location to infer
+        Returns:
+            :obj:`Location`: with top match, and alternatives
+        """
+        locations = []
+
+        if location_query is not None:
+            queried_locations = location_query(point, max_distance)
+            for (label, centroid, _) in queried_locations:
+                locations.append({
+                    'label': label,
+                    'distance': centroid.distance(point),
+                    # 'centroid': centroid,
+                    'suggestion_type': 'KB'
+                    })
+
+        api_locations = []
+        if len(locations) <= limit:
+            if concurrent:
+                futures = [QUERY_EXECUTOR.submit(query, point) for query in queries]
+                for future in futures:
+                    api_locations.extend(future.result())
+            else:
+                for query in queries:
+                    api_locations.extend(query(point))
+
+        if len(locations) > 0:
+            # Only the closest locations are kept, there's no need to sort all of them
+            locations = nsmallest(limit, locations, key=by_distance)
+            api_locations = nsmallest(limit, api_locations, key=by_distance)
+            locations = (locations + api_locations)[:limit]
+            return Location(locations[0]['label'], point, locations)
+        else:
+            return Location('#?', point, sorted(api_locations, key=by_distance))
+
+    return infer
+
 def infer_location(
         point,
         location_query,
@@ -204,6 +581,8 @@ def infer_location(
     ):
     """ Infers the semantic location of a (point) place.
 
+    To infer many points with the same settings, see make_location_inferer
+
     Args:
         points (:obj:`Point`): Point location to infer
         location_query: Function with signature, (:obj:`Point`, int) -> (str, :obj:`Point`, ...)
@@ -214,41 +593,16 @@ def infer_location(
     Returns:
         :obj:`Location`: with top match, and alternatives
     """
-    locations = []
-
-    if location_query is not None:
-        queried_locations = location_query(point, max_distance)
-        for (label, centroid, _) in queried_locations:
-            locations.append({
-                'label': label,
-                'distance': centroid.distance(point),
-                # 'centroid': centroid,
-                'suggestion_type': 'KB'
-                })
-
-    api_locations = []
-    if len(locations) <= limit:
-        if use_google and google_key:
-            google_locs = query_google(point, max_distance, google_key, debug)
-            api_locations.extend(google_locs)
-        if use_foursquare and foursquare_key:
-            foursquare_locs = query_foursquare(
-                point,
-                max_distance,
-                foursquare_key,
-                debug
-            )
-            api_locations.extend(foursquare_locs)
-    
-    if len(api_locations) > 0:
-        api_locations = sorted(api_locations, key=lambda d: d['distance'])
-
-    if len(locations) > 0:
-        locations = sorted(locations, key=lambda d: d['distance'])
-        locations = (locations + api_locations)[:limit]
-        return Location(locations[0]['label'], point, locations)
-    else:
-        return Location('#?', point, api_locations)
+    return make_location_inferer(
+        location_query,
+        max_distance,
+        use_google,
+        google_key,
+        use_foursquare,
+        foursquare_key,
+        limit,
+        debug
+    )(point)
 
 class Location(object):
     """ Location representation
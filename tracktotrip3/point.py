@@ -3,8 +3,18 @@ Point class
 """
 import math
 import datetime
+import numpy as np
 from .utils import isostr_to_datetime
 
+try:
+    from numba import njit
+except ImportError:
+    def njit(*args, **kwargs):
+        """ Stand-in for numba.njit when numba isn't installed, leaves functions as they are """
+        if len(args) == 1 and callable(args[0]):
+            return args[0]
+        return lambda func: func
+
 EPOCH = datetime.datetime.fromtimestamp(0)
 
 class Point(object):
@@ -67,7 +77,9 @@ class Point(object):
         Returns:
             float: Distance in km
         """
-        return distance(self.lat, self.lon, None, other.lat, other.lon, None, debug=self.debug)
+        return distance_kernel(
+            float(self.lat), float(self.lon), float(other.lat), float(other.lon)
+        )
 
     def time_difference(self, previous):
         """ Calcultes the time difference against another point
@@ -178,6 +190,60 @@ class Point(object):
         )
 
 
+class PointBuffer(object):
+    """ Growable, contiguous array of point positions
+
+    Positions are stored as longitude, latitude rows, like gen2arr, in a buffer
+    that doubles its capacity when full.
+
+    Attributes:
+        size (int): number of stored positions
+    """
+    def __init__(self, capacity=64, debug = False):
+        self._buf = np.empty((capacity, 2), dtype=np.float64)
+        self.size = 0
+        self.debug = debug
+
+    def __len__(self):
+        return self.size
+
+    def append(self, point):
+        """ Adds the position of a point
+
+        Args:
+            point (:obj:`Point`)
+        """
+        if self.size == len(self._buf):
+            self._buf = np.resize(self._buf, (2 * len(self._buf), 2))
+        self._buf[self.size, 0] = point.lon
+        self._buf[self.size, 1] = point.lat
+        self.size += 1
+
+    def view(self):
+        """ Stored positions, without copying them
+
+        Returns:
+            :obj:`numpy.ndarray`: (size, 2) array, valid until the next append
+        """
+        return self._buf[:self.size]
+
+    @staticmethod
+    def from_points(points, debug = False):
+        """ Creates a buffer with the positions of some points
+
+        Args:
+            points (:obj:`list` of :obj:`Point`)
+        Returns:
+            :obj:`PointBuffer`
+        """
+        size = len(points)
+        buf = PointBuffer(max(64, size), debug)
+        buf._buf[:size, 0] = np.fromiter((point.lon for point in points), np.float64, size)
+        buf._buf[:size, 1] = np.fromiter((point.lat for point in points), np.float64, size)
+        buf.size = size
+        return buf
+
+
 ONE_DEGREE = 1000. * 10000.8 / 90.
 EARTH_RADIUS = 6371 * 1000
 
@@ -185,23 +251,74 @@ def to_rad(number, debug = False):
     """ Degrees to rads """
     return number / 180. * math.pi
 
-def haversine_distance(latitude_1, longitude_1, latitude_2, longitude_2, debug = False):
-    """
-    Haversine distance between two points, expressed in meters.
-    Implemented from http://www.movable-type.co.uk/scripts/latlong.html
-    """
-    d_lat = to_rad(latitude_1 - latitude_2, debug)
-    d_lon = to_rad(longitude_1 - longitude_2, debug)
-    lat1 = to_rad(latitude_1, debug)
-    lat2 = to_rad(latitude_2, debug)
+@njit(fastmath=True, cache=True)
+def haversine_kernel(latitude_1, longitude_1, latitude_2, longitude_2):
+    """ Compiled haversine distance between two points, in meters """
+    d_lat = (latitude_1 - latitude_2) / 180. * math.pi
+    d_lon = (longitude_1 - longitude_2) / 180. * math.pi
+    lat1 = latitude_1 / 180. * math.pi
+    lat2 = latitude_2 / 180. * math.pi
 
     #pylint: disable=invalid-name
     a = math.sin(d_lat/2) * math.sin(d_lat/2) + \
         math.sin(d_lon/2) * math.sin(d_lon/2) * math.cos(lat1) * math.cos(lat2)
     c = 2 * math.atan2(math.sqrt(a), math.sqrt(1-a))
-    d = EARTH_RADIUS * c
+    return EARTH_RADIUS * c
+
+@njit(fastmath=True, cache=True)
+def distance_kernel(latitude_1, longitude_1, latitude_2, longitude_2):
+    """ Compiled 2D distance between two points, in meters
+
+    Nearby points use an equirectangular approximation, see distance
+    """
+    if abs(latitude_1 - latitude_2) > .2 or abs(longitude_1 - longitude_2) > .2:
+        return haversine_kernel(latitude_1, longitude_1, latitude_2, longitude_2)
+
+    coef = math.cos(latitude_1 / 180. * math.pi)
+    #pylint: disable=invalid-name
+    x = latitude_1 - latitude_2
+    y = (longitude_1 - longitude_2) * coef
+    return math.sqrt(x * x + y * y) * ONE_DEGREE
 
-    return d
+@njit(fastmath=True, cache=True)
+def haversine_batch(latitudes, longitudes, latitude, longitude):
+    """ Compiled haversine distances between many points and a single one, in meters """
+    lats = np.radians(latitudes)
+    lat = math.radians(latitude)
+    d_lat = lats - lat
+    d_lon = np.radians(longitudes) - math.radians(longitude)
+
+    #pylint: disable=invalid-name
+    a = np.sin(d_lat/2) ** 2 + np.sin(d_lon/2) ** 2 * np.cos(lats) * math.cos(lat)
+    return 2 * EARTH_RADIUS * np.arcsin(np.sqrt(a))
+
+def haversine_distance(latitude_1, longitude_1, latitude_2, longitude_2, debug = False):
+    """
+    Haversine distance between two points, expressed in meters.
+    Implemented from http://www.movable-type.co.uk/scripts/latlong.html
+    """
+    return haversine_kernel(
+        float(latitude_1), float(longitude_1), float(latitude_2), float(longitude_2)
+    )
+
+def haversine_distances(latitudes, longitudes, latitude, longitude, debug = False):
+    """
+    Haversine distances between many points and a single one, expressed in meters.
+
+    Args:
+        latitudes (:obj:`numpy.ndarray`)
+        longitudes (:obj:`numpy.ndarray`)
+        latitude (float)
+        longitude (float)
+    Returns:
+        :obj:`numpy.ndarray`
+    """
+    return haversine_batch(
+        np.ascontiguousarray(latitudes, dtype=np.float64),
+        np.ascontiguousarray(longitudes, dtype=np.float64),
+        float(latitude),
+        float(longitude)
+    )
 
 #pylint: disable=too-many-arguments
 def distance(latitude_1, longitude_1, elevation_1, latitude_2, longitude_2, elevation_2,
@@ -212,14 +329,16 @@ def distance(latitude_1, longitude_1, elevation_1, latitude_2, longitude_2, elev
     if haversine or (abs(latitude_1 - latitude_2) > .2 or abs(longitude_1 - longitude_2) > .2):
         return haversine_distance(latitude_1, longitude_1, latitude_2, longitude_2, debug)
 
-    coef = math.cos(latitude_1 / 180. * math.pi)
-    #pylint: disable=invalid-name
-    x = latitude_1 - latitude_2
-    y = (longitude_1 - longitude_2) * coef
-
-    distance_2d = math.sqrt(x * x + y * y) * ONE_DEGREE
+    distance_2d = distance_kernel(
+        float(latitude_1), float(longitude_1), float(latitude_2), float(longitude_2)
+    )
 
     if elevation_1 is None or elevation_2 is None or elevation_1 == elevation_2:
         return distance_2d
 
     return math.sqrt(distance_2d ** 2 + (elevation_1 - elevation_2) ** 2)
+
+# Compiles the kernels at import, instead of on the first distance
+haversine_kernel(0., 0., 0., 0.)
+distance_kernel(0., 0., 0., 0.)
+haversine_batch(np.zeros(1), np.zeros(1), 0., 0.)
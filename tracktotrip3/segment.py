@@ -9,7 +9,7 @@ from .point import Point
 from .utils import pairwise
 from .smooth import with_no_strategy, with_extrapolation, with_inverse
 from .smooth import NO_STRATEGY, INVERSE_STRATEGY, EXTRAPOLATE_STRATEGY
-from .location import infer_location
+from .location import make_location_inferer
 from .similarity import sort_segment_points, closest_point
 from .compression import spt, drp
 from .transportation_mode import speed_clustering
@@ -193,19 +193,7 @@ class Segment(object):
             :obj:`Segment`: self
         """
 
-        self.location_from = infer_location(
-            self.points[0],
-            location_query,
-            max_distance,
-            use_google,
-            google_key,
-            use_foursquare,
-            foursquare_key,
-            limit,
-            self.debug
-        )
-        self.location_to = infer_location(
-            self.points[-1],
+        infer = make_location_inferer(
             location_query,
             max_distance,
             use_google,
@@ -215,6 +203,8 @@ class Segment(object):
             limit,
             self.debug
         )
+        self.location_from = infer(self.points[0])
+        self.location_to = infer(self.points[-1])
 
         return self
 
@@ -2,8 +2,11 @@
 Location module unit tests
 """
 import unittest
+from collections import defaultdict
+import numpy as np
 from tracktotrip3 import Point
-from tracktotrip3.location import update_location_centroid, compute_centroid
+from tracktotrip3.location import update_location_centroid, compute_centroid, \
+    from_cache, insert_cache, dbscan, ClusterState
 
 class TestLocation(unittest.TestCase):
     """
@@ -26,17 +29,27 @@ class TestLocation(unittest.TestCase):
     def test_compute_centroid(self):
         """ Tests compute_centroid function
         """
-        centroid = compute_centroid([Point(0, 0, None).gen2arr()])
+        centroid = compute_centroid(np.array([Point(0, 0, None).gen2arr()]))
         self.assert_point(centroid, Point(0, 0, None))
 
         cluster = [Point(0, 0, None).gen2arr(), Point(5.0, 10.0, None).gen2arr()]
-        centroid = compute_centroid(cluster)
+        centroid = compute_centroid(np.array(cluster))
         self.assert_point(centroid, Point(2.5, 5.0, None))
 
         cluster = [Point(5.0, 10.0, None).gen2arr(), Point(5.0, 10.0, None).gen2arr()]
-        centroid = compute_centroid(cluster)
+        centroid = compute_centroid(np.array(cluster))
         self.assert_point(centroid, Point(5, 10, None))
 
+    def test_dbscan(self):
+        """ Tests dbscan, with two clusters and a noise point
+        """
+        points = np.array([
+            [-9.0, 30.0], [-8.9999, 30.0001], [2.4895, 8.0335],
+            [2.4895, 8.0335], [2.4896, 8.0335], [0.0, 0.0]
+        ])
+        labels = dbscan(points, 20, 2)
+        self.assertEqual(labels.tolist(), [0, 0, 1, 1, 1, -1])
+
     def test_ulc_empty_cluster(self):
         """ Tests update_location_centroid, with empty cluster
         """
@@ -92,5 +105,161 @@ class TestLocation(unittest.TestCase):
         self.assert_point(centroid, Point(8.0335721637393, 2.4895146785343, None))
         self.assert_points(new_cluster, [p_1, p_2, p_3, point])
 
+    def test_ulc_incremental(self):
+        """ Tests update_location_centroid, growing the same cluster with a state
+        """
+        max_distance = 20
+        min_samples = 2
+        p_1 = Point(8.0335721637393, 2.4895146785343, None)
+        p_2 = Point(8.0335721637393, 2.4895146785343, None)
+        p_3 = Point(8.0335721637393, 2.4895146785343, None)
+        far = Point(9.0, 3.0, None)
+        p_5 = Point(8.0335721637393, 2.4895146785343, None)
+        state = ClusterState()
+        cluster = []
+        for point in [p_1, p_2]:
+            centroid, cluster = update_location_centroid(
+                point, cluster, max_distance, min_samples, state=state
+            )
+
+        # Joins the biggest cluster, without reclustering
+        centroid, cluster = update_location_centroid(
+            p_3, cluster, max_distance, min_samples, state=state
+        )
+        self.assert_point(centroid, p_1)
+        self.assertEqual(state.size, 3)
+        self.assertEqual(len(state.buffer), 3)
+
+        for point in [far, p_5]:
+            centroid, cluster = update_location_centroid(
+                point, cluster, max_distance, min_samples, state=state
+            )
+        self.assert_point(centroid, p_1)
+        self.assertEqual(state.size, 4)
+        self.assert_points(cluster, [p_1, p_2, p_3, far, p_5])
+
+    def test_ulc_state_small_min_samples(self):
+        """ Tests update_location_centroid with a state, and min_samples below 2
+        """
+        point = Point(30.0, -9.0, None)
+        for min_samples in [0, 1]:
+            state = ClusterState()
+            cluster = []
+            for _ in range(3):
+                centroid, cluster = update_location_centroid(
+                    point, cluster, 20, min_samples, state=state
+                )
+            self.assert_point(centroid, point)
+
+    def test_ulc_stale_state(self):
+        """ Tests update_location_centroid, with a state of a cluster changed in place
+        """
+        max_distance = 20
+        min_samples = 3
+        state = ClusterState()
+        cluster = []
+        for _ in range(3):
+            _, cluster = update_location_centroid(
+                Point(10.0, 20.0, None), cluster, max_distance, min_samples, state=state
+            )
+        for i in range(len(cluster)):
+            cluster[i] = Point(40.0, 50.0, None)
+        centroid, cluster = update_location_centroid(
+            Point(40.0, 50.0, None), cluster, max_distance, min_samples, state=state
+        )
+        self.assert_point(centroid, Point(40.0, 50.0, None))
+
+    def test_ulc_incremental_matches_refit(self):
+        """ Tests that update_location_centroid with a state gives the same
+        centroids as reclustering every time
+        """
+        max_distance = 30
+        min_samples = 4
+        rng = np.random.default_rng(0)
+        centers = [(38.7, -9.1), (38.7003, -9.1002), (38.6998, -9.1004)]
+        state = ClusterState()
+        cluster = []
+        for _ in range(100):
+            lat, lon = centers[rng.integers(len(centers))]
+            point = Point(lat + rng.normal() * 1e-4, lon + rng.normal() * 1e-4, None)
+            centroid, cluster = update_location_centroid(
+                point, cluster, max_distance, min_samples, state=state
+            )
+            expected, _ = update_location_centroid(
+                cluster[-1], list(cluster[:-1]), max_distance, min_samples
+            )
+            self.assertAlmostEqual(centroid.lat, expected.lat, places=9)
+            self.assertAlmostEqual(centroid.lon, expected.lon, places=9)
+
+    def test_ulc_incremental_unreachable_core(self):
+        """ Tests update_location_centroid with a state, adding a core point whose
+        neighbours are all border points of the biggest cluster
+        """
+        max_distance = 20
+        min_samples = 4
+        lat_0, lon_0 = 38.7, -9.1
+        lat_m = 1 / 111195.
+        lon_m = lat_m / np.cos(np.radians(lat_0))
+
+        def at(x_m, y_m):
+            """ Point x_m meters east and y_m meters north of the origin """
+            return Point(lat_0 + y_m * lat_m, lon_0 + x_m * lon_m, None)
+
+        # Ring of core points, with arms of a core and a border point towards
+        # the origin. Border points are 15 m from the origin, cores 30 m
+        ring = [
+            at(40 * np.cos(angle), 40 * np.sin(angle))
+            for angle in np.linspace(0, 2 * np.pi, 32, endpoint=False)
+        ]
+        arms = []
+        for d_x, d_y in [(1, 0), (0, 1), (-1, 0)]:
+            arms.extend([at(30 * d_x, 30 * d_y), at(15 * d_x, 15 * d_y)])
+
+        state = ClusterState()
+        cluster = []
+        for point in ring + arms:
+            _, cluster = update_location_centroid(
+                point, cluster, max_distance, min_samples, state=state
+            )
+
+        # Core point, with only the three border points as neighbours
+        point = at(0, 0)
+        centroid, cluster = update_location_centroid(
+            point, cluster, max_distance, min_samples, state=state
+        )
+        positions = np.array([p.gen2arr() for p in cluster])
+        self.assertEqual(dbscan(positions, max_distance, min_samples)[-1], 1)
+
+        expected, _ = update_location_centroid(
+            cluster[-1], list(cluster[:-1]), max_distance, min_samples
+        )
+        self.assertAlmostEqual(centroid.lat, expected.lat, places=9)
+        self.assertAlmostEqual(centroid.lon, expected.lon, places=9)
+
+    def test_from_cache(self):
+        """ Tests from_cache, with points near cell boundaries
+        """
+        cache = {'positions': {}, 'cells': defaultdict(list)}
+        values = [{'label': 'Home'}]
+        insert_cache(cache, Point(38.7004, -9.1, None), values)
+        self.assertIs(from_cache(cache, Point(38.7005, -9.1, None), 20), values)
+        self.assertIs(from_cache(cache, Point(38.7, -9.1, None), 50), values)
+        self.assertIsNone(from_cache(cache, Point(38.7, -9.1, None), 20))
+        self.assertIs(from_cache(cache, Point(38.700401, -9.1, None), 20), values)
+        # Same rounded position, but further than the threshold
+        self.assertIsNone(from_cache(cache, Point(38.700408, -9.1, None), 0.5))
+
+    def test_from_cache_wrap(self):
+        """ Tests from_cache, across the antimeridian and over a pole
+        """
+        cache = {'positions': {}, 'cells': defaultdict(list)}
+        antimeridian = [{'label': 'Antimeridian'}]
+        pole = [{'label': 'Pole'}]
+        insert_cache(cache, Point(0.0, 179.9999, None), antimeridian)
+        insert_cache(cache, Point(89.99995, 10.0, None), pole)
+        self.assertIs(from_cache(cache, Point(0.0, -179.9999, None), 30), antimeridian)
+        self.assertIs(from_cache(cache, Point(89.99995, -170.0, None), 20), pole)
+        self.assertIs(from_cache(cache, Point(90.0, 0.0, None), 20), pole)
+
 if __name__ == '__main__':
     unittest.main()